@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import abc
 import builtins
 import dataclasses
 from flax.typing import PathParts
@@ -50,6 +51,53 @@ def to_predicate(filter: Filter) -> Predicate:
     raise TypeError(f'Invalid collection filter: {filter:!r}. ')
 
 
+def to_combined_matcher(
+  predicates: tp.Sequence[Predicate],
+) -> tp.Callable[[PathParts, tp.Any], tp.Optional[int]]:
+  """Returns a function that gives the index of the first predicate matching
+  ``(path, x)``, or None if no predicate matches.
+
+  When all predicates only depend on the type of ``x`` (e.g. type filters)
+  the index is computed once per type and cached, otherwise the predicates
+  are checked in order on every call.
+  """
+  predicates = tuple(predicates)
+
+  def first_match(path: PathParts, x: tp.Any) -> tp.Optional[int]:
+    for i, predicate in enumerate(predicates):
+      if predicate(path, x):
+        return i
+    return None
+
+  if not all(_depends_only_on_type(predicate) for predicate in predicates):
+    return first_match
+
+  cache: dict[type, tp.Optional[int]] = {}
+
+  def cached_match(path: PathParts, x: tp.Any) -> tp.Optional[int]:
+    try:
+      return cache[type(x)]
+    except KeyError:
+      index = cache[type(x)] = first_match(path, x)
+      return index
+
+  return cached_match
+
+
+def _depends_only_on_type(predicate: Predicate) -> bool:
+  if isinstance(predicate, OfType):
+    # metaclasses like typing's runtime protocols inspect the instance
+    return type(predicate.type) in (type, abc.ABCMeta)
+  elif isinstance(predicate, (Everything, Nothing)):
+    return True
+  elif isinstance(predicate, (Any, All)):
+    return all(map(_depends_only_on_type, predicate.predicates))
+  elif isinstance(predicate, Not):
+    return _depends_only_on_type(predicate.predicate)
+  else:
+    return False
+
+
 @dataclasses.dataclass
 class WithTag:
   tag: str
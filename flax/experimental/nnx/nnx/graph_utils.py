@@ -16,6 +16,8 @@ from __future__ import annotations
 
 import dataclasses
 import enum
+import functools
+import operator
 import threading
 import typing as tp
 from abc import ABCMeta
@@ -38,7 +40,6 @@ from flax.experimental.nnx.nnx.proxy_caller import (
   DelayedAccessor,
 )
 from flax.experimental.nnx.nnx.state import (
-  FlatState,
   State,
   StateLeaf,
   is_state_leaf,
@@ -50,8 +51,6 @@ A = tp.TypeVar('A')
 B = tp.TypeVar('B')
 C = tp.TypeVar('C')
 G = tp.TypeVar('G', bound='GraphNode')
-HA = tp.TypeVar('HA', bound=tp.Hashable)
-HB = tp.TypeVar('HB', bound=tp.Hashable)
 
 Index = int
 Names = tp.Sequence[int]
@@ -59,6 +58,16 @@ Node = tp.TypeVar('Node')
 Leaf = tp.TypeVar('Leaf')
 AuxData = tp.TypeVar('AuxData')
 
+# sentinel for dict lookups where None is a valid value
+_MISSING = object()
+
+# kinds of values found in graph nodes, plain ints instead of an enum.Enum
+# because they are compared once per attribute in the traversal loops
+_NODE = 0
+_VARIABLE = 1
+_STATE_LEAF = 2
+_STATIC = 3
+
 Updates = tp.Union[
   A,
   'GraphDef[A]',
@@ -69,61 +78,70 @@ Updates = tp.Union[
 ]
 
 
+# Caches of pure functions of their arguments are process-global lru_caches,
+# caches that depend on the registered node types live on CONTEXT.
+
+
+@functools.lru_cache(maxsize=4096)
+def _intern_attributes(attributes: tuple[Key, ...]) -> tuple[Key, ...]:
+  """Returns a canonical tuple equal to ``attributes``.
+
+  Many graph nodes share the same attributes (e.g. every Linear), so NodeDef
+  comparisons can short-circuit on identity.
+  """
+  return attributes
+
+
 @dataclasses.dataclass
 class GraphUtilsContext(threading.local):
   node_types: dict[
     type, 'NodeImpl[tp.Any, tp.Any, tp.Any]'
   ] = dataclasses.field(default_factory=dict)
+  # maps a type to the kind of its instances and their NodeImpl, if nodes
+  type_info_cache: dict[
+    type, tuple[int, tp.Optional['NodeImpl[tp.Any, tp.Any, tp.Any]']]
+  ] = dataclasses.field(default_factory=dict)
   seen_modules_repr: tp.Optional[tp.Set[ids.UUID]] = None
 
 
 CONTEXT = GraphUtilsContext()
 
 
-class _HashById(tp.Hashable, tp.Generic[A]):
-  """A wrapper around a value that uses its id for hashing and equality.
-  This is used by RefMap to explicitly use object id as the hash for the keys.
-  """
-
-  __slots__ = ('_value',)
-
-  def __init__(self, value: A):
-    self._value = value
-
-  @property
-  def value(self) -> A:
-    return self._value
-
-  def __hash__(self) -> int:
-    return id(self._value)
-
-  def __eq__(self, other: tp.Any) -> bool:
-    return isinstance(other, _HashById) and self._value is other._value
-
-
 class RefMap(tp.MutableMapping[A, B], reprlib.MappingReprMixin[A, B]):
-  """A mapping that uses object id as the hash for the keys."""
+  """A mapping that uses object id as the hash for the keys.
+
+  Entries are stored as ``id(key) -> (key, value)``, keeping a strong
+  reference to the key so its id cannot be reused while it is in the map.
+  """
 
   def __init__(
     self, mapping: tp.Mapping[A, B] | tp.Iterable[tuple[A, B]] = (), /
   ):
-    self._mapping: dict[_HashById[A], B] = {}
+    self._mapping: dict[int, tuple[A, B]] = {}
     self.update(mapping)
 
   def __getitem__(self, key: A) -> B:
-    return self._mapping[_HashById(key)]
+    return self._mapping[id(key)][1]
 
   def __contains__(self, key: object) -> bool:
-    return _HashById(key) in self._mapping
+    return id(key) in self._mapping
+
+  def get(self, key: A, default: tp.Any = None) -> tp.Any:
+    # single dict probe instead of the Mapping mixin's __getitem__ + KeyError
+    entry = self._mapping.get(id(key))
+    return default if entry is None else entry[1]
 
   def __setitem__(self, key: A, value: B):
-    self._mapping[_HashById(key)] = value
+    self._mapping[id(key)] = (key, value)
 
   def __delitem__(self, key: A):
-    del self._mapping[_HashById(key)]
+    del self._mapping[id(key)]
 
   def __iter__(self) -> tp.Iterator[A]:
-    return (x.value for x in self._mapping)
+    return (key for key, _ in self._mapping.values())
+
+  def items(self) -> tp.ItemsView[A, B]:
+    return _RefMapItemsView(self)
 
   def __len__(self) -> int:
     return len(self._mapping)
@@ -132,6 +150,13 @@ class RefMap(tp.MutableMapping[A, B], reprlib.MappingReprMixin[A, B]):
     return repr(self)
 
 
+class _RefMapItemsView(tp.ItemsView[A, B]):
+  _mapping: RefMap[A, B]
+
+  def __iter__(self) -> tp.Iterator[tuple[A, B]]:
+    # entries are already stored as (key, value) pairs
+    return iter(self._mapping._mapping.values())
+
 
 @dataclasses.dataclass(frozen=True)
 class NodeImplBase(tp.Generic[Node, Leaf, AuxData]):
@@ -142,6 +167,11 @@ class NodeImplBase(tp.Generic[Node, Leaf, AuxData]):
     nodes, _ = self.flatten(node)
     return dict(nodes)
 
+  def node_items(self, node: Node) -> tp.Sequence[tuple[Key, Leaf]]:
+    # for callers that only iterate, avoids building a dict
+    nodes, _ = self.flatten(node)
+    return nodes
+
 
 @dataclasses.dataclass(frozen=True)
 class GraphNodeImpl(NodeImplBase[Node, Leaf, AuxData]):
@@ -149,10 +179,7 @@ class GraphNodeImpl(NodeImplBase[Node, Leaf, AuxData]):
   pop_key: tp.Callable[[Node, Key], Leaf]
   create_empty: tp.Callable[[AuxData], Node]
   clear: tp.Callable[[Node, AuxData], None]
-
-  def init(self, node: Node, items: tuple[tuple[Key, Leaf], ...]):
-    for key, value in items:
-      self.set_key(node, key, value)
+  init: tp.Callable[[Node, tuple[tuple[Key, Leaf], ...]], None]
 
 
 @dataclasses.dataclass(frozen=True)
@@ -172,7 +199,20 @@ def register_graph_node_type(
   pop_key: tp.Callable[[Node, Key], Leaf],
   create_empty: tp.Callable[[AuxData], Node],
   clear: tp.Callable[[Node, AuxData], None],
+  init: tp.Callable[[Node, tuple[tuple[Key, Leaf], ...]], None] | None = None,
 ):
+  """Registers ``type`` as a graph node type.
+
+  ``init`` is an optional fast path to set all the attributes of a node
+  created by ``create_empty`` (or emptied by ``clear``) at once, if not given
+  ``set_key`` is called for each attribute.
+  """
+  if init is None:
+
+    def init(node: Node, items: tuple[tuple[Key, Leaf], ...]):
+      for key, value in items:
+        set_key(node, key, value)
+
   CONTEXT.node_types[type] = GraphNodeImpl(
     type=type,
     flatten=flatten,
@@ -180,15 +220,55 @@ def register_graph_node_type(
     pop_key=pop_key,
     create_empty=create_empty,
     clear=clear,
+    init=init,
   )
+  CONTEXT.type_info_cache.clear()
 
 
-def is_node(x: tp.Any) -> bool:
+def _type_info(
+  x: tp.Any,
+) -> tuple[int, NodeImpl[tp.Any, tp.Any, tp.Any] | None]:
+  """Returns the kind of ``x`` (``_NODE``, ``_VARIABLE``, ``_STATE_LEAF`` or
+  ``_STATIC``) and its NodeImpl if ``x`` is a node, else None.
+
+  Both only depend on the type of ``x``. The result is cached per type for
+  Variables, graph node types and builtin types, until a new graph node type
+  is registered. Other types are not cached since they can be registered as
+  pytrees with jax at any time.
+  """
+  node_type = type(x)
+  type_info_cache = CONTEXT.type_info_cache
+  try:
+    return type_info_cache[node_type]
+  except KeyError:
+    pass
+
+  info: tuple[int, NodeImpl[tp.Any, tp.Any, tp.Any] | None]
   if isinstance(x, Variable):
-    return False
-  elif type(x) in CONTEXT.node_types:
-    return True
-  return is_pytree_node(x)
+    info = (_VARIABLE, None)
+  elif node_type in CONTEXT.node_types:
+    info = (_NODE, CONTEXT.node_types[node_type])
+  else:
+    if is_pytree_node(x):
+      info = (_NODE, PYTREE_NODE_IMPL)
+    elif is_state_leaf(x):
+      info = (_STATE_LEAF, None)
+    else:
+      info = (_STATIC, None)
+    if node_type not in _PYTREE_QUICK:
+      return info
+
+  type_info_cache[node_type] = info
+  return info
+
+
+def _lookup_node_impl(x: tp.Any) -> NodeImpl[tp.Any, tp.Any, tp.Any] | None:
+  """Returns the NodeImpl for ``x`` or None if ``x`` is not a node."""
+  return _type_info(x)[1]
+
+
+def is_node(x: tp.Any) -> bool:
+  return _lookup_node_impl(x) is not None
 
 
 def is_graph_node(x: tp.Any) -> bool:
@@ -200,18 +280,14 @@ def is_node_type(x: type[tp.Any]) -> bool:
 
 
 def get_node_impl(x: Node) -> NodeImpl[Node, tp.Any, tp.Any]:
-  if isinstance(x, Variable):
-    raise ValueError(f'Variable is not a node: {x}')
+  node_impl = _lookup_node_impl(x)
 
-  node_type = type(x)
+  if node_impl is None:
+    if isinstance(x, Variable):
+      raise ValueError(f'Variable is not a node: {x}')
+    raise ValueError(f'Unknown node type: {x}')
 
-  if node_type not in CONTEXT.node_types:
-    if is_pytree_node(x):
-      return PYTREE_NODE_IMPL
-    else:
-      raise ValueError(f'Unknown node type: {x}')
-
-  return CONTEXT.node_types[node_type]
+  return node_impl
 
 
 def get_node_impl_for_type(x: type[Node]) -> NodeImpl[Node, tp.Any, tp.Any]:
@@ -220,34 +296,6 @@ def get_node_impl_for_type(x: type[Node]) -> NodeImpl[Node, tp.Any, tp.Any]:
   return CONTEXT.node_types[x]
 
 
-class _HashableMapping(tp.Mapping[HA, HB], tp.Hashable):
-  def __init__(self, mapping: tp.Mapping[HA, HB] | tp.Iterable[tuple[HA, HB]]):
-    self._mapping = dict(mapping)
-
-  def __contains__(self, key: object) -> bool:
-    return key in self._mapping
-
-  def __getitem__(self, key: HA) -> HB:
-    return self._mapping[key]
-
-  def __iter__(self) -> tp.Iterator[HA]:
-    return iter(self._mapping)
-
-  def __len__(self) -> int:
-    return len(self._mapping)
-
-  def __hash__(self) -> int:
-    return hash(tuple(sorted(self._mapping.items())))
-
-  def __eq__(self, other: tp.Any) -> bool:
-    return (
-      isinstance(other, _HashableMapping) and self._mapping == other._mapping
-    )
-
-  def __repr__(self) -> str:
-    return repr(self._mapping)
-
-
 @dataclasses.dataclass(repr=False)
 class _MappingRepr(reprlib.Representable):
   mapping: tp.Mapping[Key, tp.Any]
@@ -264,6 +312,7 @@ class VariableDef(reprlib.Representable):
     '_type',
     '_index',
     '_metadata',
+    '_hash',
   )
 
   def __init__(
@@ -275,6 +324,7 @@ class VariableDef(reprlib.Representable):
     self._type = type
     self._index = index
     self._metadata = metadata
+    self._hash: int | None = None
 
   def __nnx_repr__(self):
     yield reprlib.Object(type=type(self))
@@ -297,6 +347,8 @@ class VariableDef(reprlib.Representable):
 
   @classmethod
   def from_variable(cls, variable: Variable[tp.Any], index: int) -> VariableDef:
+    # metadata keys vary per instance, copying the whole dict and deleting
+    # the two non-metadata entries is faster than a filtering comprehension
     metadata = vars(variable).copy()
     del metadata['raw_value']
     del metadata['_trace_state']
@@ -312,7 +364,12 @@ class VariableDef(reprlib.Representable):
     return variables
 
   def __hash__(self):
-    return hash((self._type, self._index, tuple(self._metadata.items())))
+    h = self._hash
+    if h is None:
+      h = self._hash = hash(
+        (self._type, self._index, tuple(self._metadata.items()))
+      )
+    return h
 
   def __eq__(self, other):
     if not isinstance(other, VariableDef):
@@ -323,14 +380,19 @@ class VariableDef(reprlib.Representable):
       and self._metadata == other._metadata
     )
 
+  def __reduce__(self):
+    # the cached hash is not stable across processes, don't serialize it
+    return type(self), (self._type, self._index, self._metadata)
+
+
 @dataclasses.dataclass(frozen=True)
 class NodeDef(tp.Generic[Node], reprlib.Representable):
   type: tp.Type[Node]
   index: int
   attributes: tuple[Key, ...]
-  subgraphs: _HashableMapping[Key, tp.Union['NodeDef[tp.Any]', int]]
-  static_fields: _HashableMapping[Key, tp.Any]
-  variables: _HashableMapping[Key, VariableDef | int]
+  subgraphs: dict[Key, tp.Union['NodeDef[tp.Any]', int]]
+  static_fields: dict[Key, tp.Any]
+  variables: dict[Key, VariableDef | int]
   metadata: tp.Any
 
   @classmethod
@@ -348,9 +410,9 @@ class NodeDef(tp.Generic[Node], reprlib.Representable):
       type=type,
       index=index,
       attributes=attributes,
-      subgraphs=_HashableMapping(subgraphs),
-      static_fields=_HashableMapping(static_fields),
-      variables=_HashableMapping(variables),
+      subgraphs=dict(subgraphs),
+      static_fields=dict(static_fields),
+      variables=dict(variables),
       metadata=metadata,
     )
 
@@ -365,6 +427,31 @@ class NodeDef(tp.Generic[Node], reprlib.Representable):
     yield reprlib.Attr('variables', _MappingRepr(self.variables))
     yield reprlib.Attr('metadata', self.metadata)
 
+  def __hash__(self) -> int:
+    # NodeDef is immutable, we cache the hash on first use. The mappings are
+    # plain dicts for fast lookups during unflatten, they are hashed as
+    # frozensets of their items.
+    h = vars(self).get('_hash')
+    if h is None:
+      h = hash(
+        (
+          self.type,
+          self.index,
+          self.attributes,
+          frozenset(self.subgraphs.items()),
+          frozenset(self.static_fields.items()),
+          frozenset(self.variables.items()),
+          self.metadata,
+        )
+      )
+      object.__setattr__(self, '_hash', h)
+    return h
+
+  def __getstate__(self):
+    state = vars(self).copy()
+    state.pop('_hash', None)
+    return state
+
 
 @dataclasses.dataclass(frozen=True)
 class GraphDef(tp.Generic[Node], reprlib.Representable):
@@ -382,9 +469,19 @@ class GraphDef(tp.Generic[Node], reprlib.Representable):
     index_mapping = deepcopy(self.index_mapping, memo)
     return GraphDef(nodedef, index_mapping)
 
-  def __hash__(self):
-    # refmap is opaque
-    return hash(self.nodedef)
+  def __hash__(self) -> int:
+    # refmap is opaque, the hash is cached on first use since GraphDef is
+    # hashed on every jit dispatch as part of the static arguments
+    h = vars(self).get('_hash')
+    if h is None:
+      h = hash(self.nodedef)
+      object.__setattr__(self, '_hash', h)
+    return h
+
+  def __getstate__(self):
+    state = vars(self).copy()
+    state.pop('_hash', None)
+    return state
 
   def __eq__(self, other):
     # refmap is opaque
@@ -406,7 +503,7 @@ class GraphDef(tp.Generic[Node], reprlib.Representable):
       module = merge(self, state, *states)
       fn = accessor(module)
       out = fn(*args, **kwargs)
-      return out, graph_flatten(module)[:2]
+      return out, graph_flatten(module, need_refmap=False)[:2]
 
     return CallableProxy(_apply, accessor)  # type: ignore
 
@@ -439,73 +536,159 @@ def graph_flatten(
   /,
   *,
   idxmap: dict[Index, tp.Any] | None = None,
-) -> tuple[GraphDef[Node], State, RefMap[tp.Any, Index]]:
-  refmap = RefMap[tp.Any, Index]()
+  need_refmap: bool = True,
+) -> tuple[GraphDef[Node], State, RefMap[tp.Any, Index] | None]:
+  """Flattens a graph node into a graphdef and a state.
+
+  Args:
+    x: the graph node to flatten.
+    idxmap: an optional mapping from outer indexes to nodes, used to compute
+      the ``index_mapping`` of the resulting graphdef.
+    need_refmap: if False the ``RefMap`` from nodes to indexes is not built
+      and ``None`` is returned in its place, callers that discard it (e.g.
+      ``split``) should pass False.
+  """
+  # nodes are tracked by id during the traversal, they are kept alive by x
+  node_index: dict[int, Index] = {}
+  nodes: list[tp.Any] = []
   flat_state: dict[PathParts, StateLeaf] = {}
-  nodedef = _graph_flatten((), refmap, flat_state, x)
+  nodedef = _graph_flatten([], node_index, nodes, flat_state, x)
   assert not isinstance(nodedef, int)
   if idxmap is not None:
-    index_to_index = compose_mapping(idxmap, refmap)
+    index_to_index = {
+      a: node_index[id(b)] for a, b in idxmap.items() if id(b) in node_index
+    }
   else:
     index_to_index = None
   graphdef = GraphDef(nodedef, index_to_index)
+  if need_refmap:
+    refmap = RefMap[tp.Any, Index](zip(nodes, range(len(nodes))))
+  else:
+    refmap = None
   return graphdef, State.from_flat_path(flat_state), refmap
 
 
+class _FlattenFrame:
+  """A node whose attributes are being visited by ``_graph_flatten``.
+
+  Graph traversals in this module use an explicit stack of frames instead
+  of recursion so deep graphs don't hit the recursion limit. A frame is
+  pushed when a subgraph is reached and resumed once it is done, visiting
+  nodes in the same order as a recursive traversal.
+  """
+
+  __slots__ = (
+    'key',
+    'node_impl',
+    'index',
+    'attributes',
+    'metadata',
+    'items',
+    'subgraphs',
+    'static_fields',
+    'variables',
+  )
+
+  def __init__(
+    self,
+    key: Key | None,
+    node_index: dict[int, Index],
+    nodes: list[tp.Any],
+    node: tp.Any,
+    node_impl: NodeImpl[tp.Any, tp.Any, tp.Any],
+  ):
+    # only cache graph nodes
+    if isinstance(node_impl, GraphNodeImpl):
+      index = node_index[id(node)] = len(nodes)
+      nodes.append(node)
+    else:
+      index = -1
+
+    values, metadata = node_impl.flatten(node)
+    self.key = key
+    self.node_impl = node_impl
+    self.index = index
+    attributes = tuple(key for key, _ in values)
+    if index >= 0:
+      # only graph nodes, pytree keys can be arbitrary values and == would
+      # conflate e.g. 1 and True
+      attributes = _intern_attributes(attributes)
+    self.attributes = attributes
+    self.metadata = metadata
+    self.items = iter(values)
+    self.subgraphs: dict[Key, tp.Union[NodeDef[tp.Any], int]] = {}
+    self.static_fields: dict[Key, tp.Any] = {}
+    self.variables: dict[Key, VariableDef | int] = {}
+
+  def nodedef(self) -> NodeDef[tp.Any]:
+    # the frame is discarded after this, the NodeDef takes ownership of
+    # its dicts instead of copying them like NodeDef.create does
+    return NodeDef(
+      type=self.node_impl.type,
+      index=self.index,
+      attributes=self.attributes,
+      subgraphs=self.subgraphs,
+      static_fields=self.static_fields,
+      variables=self.variables,
+      metadata=self.metadata,
+    )
+
+
 def _graph_flatten(
-  path: PathParts,
-  refmap: RefMap[tp.Any, Index],
+  path_stack: list[Key],
+  node_index: dict[int, Index],
+  nodes: list[tp.Any],
   flat_state: dict[PathParts, StateLeaf],
   node: Node,
 ) -> NodeDef[Node] | int:
-  if not is_node(node):
+  node_impl = _lookup_node_impl(node)
+  if node_impl is None:
     raise RuntimeError(f'Unsupported type: {type(node)}, this is a bug.')
 
-  if node in refmap:
-    return refmap[node]
-
-  node_impl = get_node_impl(node)
-
-  # only cache graph nodes
-  if isinstance(node_impl, GraphNodeImpl):
-    index = len(refmap)
-    refmap[node] = index
-  else:
-    index = -1
-
-  subgraphs: list[tuple[Key, tp.Union[NodeDef[Node], int]]] = []
-  static_fields: list[tuple[Key, tp.Any]] = []
-  variables: list[tuple[Key, VariableDef | int]] = []
-
-  values, metadata = node_impl.flatten(node)
-  for key, value in values:
-    if is_node(value):
-      nodedef = _graph_flatten((*path, key), refmap, flat_state, value)
-      subgraphs.append((key, nodedef))
-    elif isinstance(value, Variable):
-      if value in refmap:
-        variables.append((key, refmap[value]))
+  if id(node) in node_index:
+    return node_index[id(node)]
+
+  type_info_cache = CONTEXT.type_info_cache
+  node_index_get = node_index.get
+  stack = [_FlattenFrame(None, node_index, nodes, node, node_impl)]
+  while True:
+    frame = stack[-1]
+    subgraphs = frame.subgraphs
+    variables = frame.variables
+    static_fields = frame.static_fields
+    for key, value in frame.items:
+      info = type_info_cache.get(type(value))
+      if info is None:
+        info = _type_info(value)
+      kind, node_impl = info
+      if kind == _NODE:
+        index = node_index_get(id(value))
+        if index is not None:
+          subgraphs[key] = index
+        else:
+          path_stack.append(key)
+          stack.append(_FlattenFrame(key, node_index, nodes, value, node_impl))
+          break
+      elif kind == _VARIABLE:
+        index = node_index_get(id(value))
+        if index is not None:
+          variables[key] = index
+        else:
+          flat_state[(*path_stack, key)] = value.copy()
+          variable_index = node_index[id(value)] = len(nodes)
+          nodes.append(value)
+          variables[key] = VariableDef.from_variable(value, variable_index)
+      elif kind == _STATE_LEAF:
+        flat_state[(*path_stack, key)] = value
       else:
-        flat_state[(*path, key)] = value.copy()
-        variable_index = refmap[value] = len(refmap)
-        variables.append(
-          (key, VariableDef.from_variable(value, variable_index))
-        )
-    elif is_state_leaf(value):
-      flat_state[(*path, key)] = value
+        static_fields[key] = value
     else:
-      static_fields.append((key, value))
-
-  nodedef = NodeDef.create(
-    type=node_impl.type,
-    index=index,
-    attributes=tuple(key for key, _ in values),
-    subgraphs=subgraphs,
-    static_fields=static_fields,
-    variables=variables,
-    metadata=metadata,
-  )
-  return nodedef
+      stack.pop()
+      nodedef = frame.nodedef()
+      if not stack:
+        return nodedef
+      path_stack.pop()
+      stack[-1].subgraphs[frame.key] = nodedef
 
 
 def graph_unflatten(
@@ -533,13 +716,83 @@ def graph_unflatten(
   return node, index_to_ref
 
 
+class _UnflattenFrame:
+  """A node whose children are being rebuilt by ``_graph_unflatten``."""
+
+  __slots__ = (
+    'key',
+    'nodedef',
+    'node_impl',
+    'state',
+    'node',
+    'attributes',
+    'children',
+  )
+
+  def __init__(
+    self,
+    key: Key | None,
+    nodedef: NodeDef[tp.Any],
+    state: dict[Key, StateLeaf | dict[Key, tp.Any]],
+    index_to_ref: dict[Index, tp.Any],
+    idxmap: dict[Index, tp.Any] | None,
+  ):
+    if not is_node_type(nodedef.type):
+      raise RuntimeError(f'Unsupported type: {nodedef.type}, this is a bug.')
+
+    if nodedef.index in index_to_ref:
+      raise RuntimeError(f'NodeDef index {nodedef.index} already used.')
+
+    node_impl = get_node_impl_for_type(nodedef.type)
+
+    if isinstance(node_impl, GraphNodeImpl):
+      # we create an empty node first and add it to the index
+      # this avoids infinite recursion when there is a reference cycle
+      if idxmap is not None and nodedef.index in idxmap:
+        node = idxmap[nodedef.index]
+        if type(node) != nodedef.type:
+          raise ValueError(
+            f'Expected a node of type {nodedef.type} for index '
+            f'{nodedef.index}, but got a node of type {type(node)}.'
+          )
+        node_impl.clear(node, nodedef.metadata)
+      else:
+        node = node_impl.create_empty(nodedef.metadata)
+      index_to_ref[nodedef.index] = node
+    else:
+      # if the node type does not support the creation of an empty object it
+      # means that it cannot reference itself, so we create it after its
+      # children
+      node = None
+
+    self.key = key
+    self.nodedef = nodedef
+    self.node_impl = node_impl
+    self.state = state
+    self.node = node
+    self.attributes = iter(nodedef.attributes)
+    self.children: dict[Key, StateLeaf | tp.Any] = {}
+
+  def finalize(self) -> tp.Any:
+    for new_key in set(self.state) - set(self.nodedef.attributes):
+      raise ValueError(f'Unknown key: {new_key!r}')
+
+    node_impl = self.node_impl
+    children = tuple(self.children.items())
+    if isinstance(node_impl, GraphNodeImpl):
+      node_impl.init(self.node, children)
+      return self.node
+    else:
+      return node_impl.unflatten(children, self.nodedef.metadata)
+
+
 def _graph_unflatten(
   nodedef: tp.Union[NodeDef[Node], int],
   state: dict[Key, StateLeaf | dict[Key, tp.Any]],
   index_to_ref: dict[Index, tp.Any],
   idxmap: dict[Index, tp.Any] | None,
 ) -> Node:
-  """Recursive helper for graph_unflatten.
+  """Helper for graph_unflatten.
 
   Args:
     nodedef: A NodeDef instance or an index to a node in the cache.
@@ -555,37 +808,33 @@ def _graph_unflatten(
   if isinstance(nodedef, int):
     return index_to_ref[nodedef]
 
-  if not is_node_type(nodedef.type):
-    raise RuntimeError(f'Unsupported type: {nodedef.type}, this is a bug.')
-
-  if nodedef.index in index_to_ref:
-    raise RuntimeError(f'NodeDef index {nodedef.index} already used.')
-
-  node_impl = get_node_impl_for_type(nodedef.type)
-
-  def _get_children():
-    children: dict[str, StateLeaf | Node] = {}
-
-    for key in nodedef.attributes:
-      if key in nodedef.static_fields:
-        children[key] = nodedef.static_fields[key]
-      elif key not in state:
+  stack = [_UnflattenFrame(None, nodedef, state, index_to_ref, idxmap)]
+  while True:
+    frame = stack[-1]
+    nodedef = frame.nodedef
+    static_fields = nodedef.static_fields
+    subgraphs = nodedef.subgraphs
+    variables = nodedef.variables
+    state = frame.state
+    children = frame.children
+    for key in frame.attributes:
+      if (value := static_fields.get(key, _MISSING)) is not _MISSING:
+        children[key] = value
+      elif (value := state.get(key, _MISSING)) is _MISSING:
         # TODO(cgarcia): maybe we shouldn't support unflattening with missing keys?
         # if key is not present create an empty types
-        if key in nodedef.subgraphs:
+        if (subgraphdef := subgraphs.get(key, _MISSING)) is not _MISSING:
           # if the key is a subgraph we create an empty node
-          subgraphdef = nodedef.subgraphs[key]
           if isinstance(subgraphdef, int):
             # subgraph exists, take it from the cache
             children[key] = index_to_ref[subgraphdef]
           else:
             # create an empty node and add it to the cache
-            substate = {}
-            node = children[key] = _graph_unflatten(
-              subgraphdef, substate, index_to_ref, idxmap
+            stack.append(
+              _UnflattenFrame(key, subgraphdef, {}, index_to_ref, idxmap)
             )
-        elif key in nodedef.variables:
-          variable_def = nodedef.variables[key]
+            break
+        elif (variable_def := variables.get(key, _MISSING)) is not _MISSING:
           if isinstance(variable_def, int):
             # variable exists, take it from the cache
             children[key] = index_to_ref[variable_def]
@@ -608,24 +857,22 @@ def _graph_unflatten(
         else:
           raise RuntimeError(f'Unknown static field: {key!r}')
       else:
-        value = state[key]
-        if key in nodedef.subgraphs:
+        if (subgraphdef := subgraphs.get(key, _MISSING)) is not _MISSING:
           if is_state_leaf(value):
             raise ValueError(
               f'Expected a subgraph for {key!r}, but got a Variable.'
             )
           assert isinstance(value, dict)
-          subgraphdef = nodedef.subgraphs[key]
 
           if isinstance(subgraphdef, int):
-            node = index_to_ref[subgraphdef]
+            children[key] = index_to_ref[subgraphdef]
           else:
-            node = children[key] = _graph_unflatten(
-              subgraphdef, value, index_to_ref, idxmap
+            stack.append(
+              _UnflattenFrame(key, subgraphdef, value, index_to_ref, idxmap)
             )
+            break
 
-        elif key in nodedef.variables:
-          variable_def = nodedef.variables[key]
+        elif (variable_def := variables.get(key, _MISSING)) is not _MISSING:
           if isinstance(variable_def, int):
             children[key] = index_to_ref[variable_def]
           else:
@@ -650,34 +897,12 @@ def _graph_unflatten(
             index_to_ref[variable_def.index] = variable
         elif is_state_leaf(value):
           children[key] = value
-    for new_key in set(state) - set(nodedef.attributes):
-      raise ValueError(f'Unknown key: {new_key!r}')
-
-    return children
-
-  if isinstance(node_impl, GraphNodeImpl):
-    # we create an empty node first and add it to the index
-    # this avoids infinite recursion when there is a reference cycle
-    if idxmap is not None and nodedef.index in idxmap:
-      node = idxmap[nodedef.index]
-      if type(node) != nodedef.type:
-        raise ValueError(
-          f'Expected a node of type {nodedef.type} for index '
-          f'{nodedef.index}, but got a node of type {type(node)}.'
-        )
-      node_impl.clear(node, nodedef.metadata)
     else:
-      node = node_impl.create_empty(nodedef.metadata)
-    index_to_ref[nodedef.index] = node
-    children = _get_children()
-    node_impl.init(node, tuple(children.items()))
-  else:
-    # if the node type does not support the creation of an empty object it means
-    # that it cannot reference itself, so we can create its children first
-    children = _get_children()
-    node = node_impl.unflatten(tuple(children.items()), nodedef.metadata)
-
-  return node
+      stack.pop()
+      node = frame.finalize()
+      if not stack:
+        return node
+      stack[-1].children[frame.key] = node
 
 
 def graph_pop(
@@ -685,19 +910,26 @@ def graph_pop(
   filters: tuple[filterlib.Filter, ...],
 ) -> tuple[State, ...]:
   id_to_index: dict[int, Index] = {}
-  path_parts: PathParts = ()
+  path_stack: list[Key] = []
   predicates = tuple(filterlib.to_predicate(filter) for filter in filters)
-  flat_states: tuple[FlatState, ...] = tuple({} for _ in predicates)
-  _graph_pop(node, id_to_index, path_parts, flat_states, predicates)
-  return tuple(State.from_flat_path(flat_state) for flat_state in flat_states)
+  match = filterlib.to_combined_matcher(predicates)
+  # popped leaves are collected as (path, value) pairs, paths are unique
+  # since each value is only visited once
+  flat_states: tuple[list[tuple[PathParts, StateLeaf]], ...] = tuple(
+    [] for _ in predicates
+  )
+  # bound appends of the destination states, indexed by matched predicate
+  appends = tuple(flat_state.append for flat_state in flat_states)
+  _graph_pop(node, id_to_index, path_stack, match, appends)
+  return tuple(State.from_flat_pairs(flat_state) for flat_state in flat_states)
 
 
 def _graph_pop(
   node: tp.Any,
   id_to_index: dict[int, Index],
-  path_parts: PathParts,
-  flat_states: tuple[FlatState, ...],
-  predicates: tuple[filterlib.Predicate, ...],
+  path_stack: list[Key],
+  match: tp.Callable[[PathParts, tp.Any], int | None],
+  appends: tuple[tp.Callable[[tuple[PathParts, StateLeaf]], None], ...],
 ) -> None:
   if not is_node(node):
     raise RuntimeError(f'Unsupported type: {type(node)}, this is a bug.')
@@ -707,89 +939,111 @@ def _graph_pop(
 
   id_to_index[id(node)] = len(id_to_index)
   node_impl = get_node_impl(node)
-  node_dict = node_impl.node_dict(node)
 
-  for name, value in node_dict.items():
-    if is_node(value):
-      _graph_pop(
-        node=value,
-        id_to_index=id_to_index,
-        path_parts=(*path_parts, name),
-        flat_states=flat_states,
-        predicates=predicates,
-      )
-      continue
-    elif not is_state_leaf(value):
-      continue
-    elif id(value) in id_to_index:
-      continue
-
-    node_path = (*path_parts, name)
-    node_impl = get_node_impl(node)
-    for state, predicate in zip(flat_states, predicates):
-      if predicate(node_path, value):
-        if isinstance(node_impl, PytreeNodeImpl):
-          raise ValueError(
-            f'Cannot pop key {name!r} from node of type {type(node).__name__}'
-          )
+  stack = [(node, node_impl, iter(node_impl.node_items(node)))]
+  while stack:
+    node, node_impl, items = stack[-1]
+    for name, value in items:
+      kind, value_impl = _type_info(value)
+      if kind == _NODE:
+        # shared subgraphs are skipped before being pushed
+        if id(value) in id_to_index:
+          continue
         id_to_index[id(value)] = len(id_to_index)
-        node_impl.pop_key(node, name)
-        if isinstance(value, Variable):
-          value = value.copy()
-        state[node_path] = value
+        path_stack.append(name)
+        stack.append((value, value_impl, iter(value_impl.node_items(value))))
         break
+      elif kind == _STATIC:
+        continue
+      elif id(value) in id_to_index:
+        continue
+
+      node_path = (*path_stack, name)
+      i = match(node_path, value)
+      if i is None:
+        # NOTE: should we raise an error here?
+        continue
+      if isinstance(node_impl, PytreeNodeImpl):
+        raise ValueError(
+          f'Cannot pop key {name!r} from node of type {type(node).__name__}'
+        )
+      id_to_index[id(value)] = len(id_to_index)
+      node_impl.pop_key(node, name)
+      if kind == _VARIABLE:
+        value = value.copy()
+      appends[i]((node_path, value))
     else:
-      # NOTE: should we raise an error here?
-      pass
+      stack.pop()
+      if stack:
+        path_stack.pop()
 
 
 def _graph_update_dynamic(node: tp.Any, state: dict[Key, tp.Any]):
-  if not is_node(node):
-    raise RuntimeError(f'Unsupported type: {type(node)}')
+  stack = [_update_dynamic_frame(node, state)]
+  while stack:
+    node, node_impl, node_dict, items = stack[-1]
+    for key, value in items:
+      value_kind = _type_info(value)[0]
 
-  node_impl = get_node_impl(node)
-  node_dict = node_impl.node_dict(node)
-  for key, value in state.items():
-    # case 1: new state is being added
-    if key not in node_dict:
-      if isinstance(node_impl, PytreeNodeImpl):
-        raise ValueError(
-          f'Cannot set key {key!r} on immutable node of '
-          f'type {type(node).__name__}'
-        )
-      if isinstance(value, Variable):
-        value = value.copy()
-      node_impl.set_key(node, key, value)
-      continue
-
-    # check values are of the same type
-    current_value = node_dict[key]
-
-    # case 2: subgraph is being updated
-    if is_node(current_value):
-      if is_state_leaf(value):
-        raise ValueError(f'Expected a subgraph for {key!r}, but got: {value!r}')
-      _graph_update_dynamic(current_value, value)
-    elif isinstance(value, Variable):
-      # case 3: state leaf is being updated
-      if not isinstance(current_value, Variable):
-        raise ValueError(
-          f'Trying to update a non-Variable attribute {key!r} with a Variable: '
-          f'{value!r}'
-        )
-      current_value.copy_from(value)
-    elif is_state_leaf(value):
-      # case 4: state field is being updated
-      if isinstance(node_impl, PytreeNodeImpl):
+      # case 1: new state is being added
+      if key not in node_dict:
+        if isinstance(node_impl, PytreeNodeImpl):
+          raise ValueError(
+            f'Cannot set key {key!r} on immutable node of '
+            f'type {type(node).__name__}'
+          )
+        if value_kind == _VARIABLE:
+          value = value.copy()
+        node_impl.set_key(node, key, value)
+        continue
+
+      # check values are of the same type
+      current_value = node_dict[key]
+
+      # case 2: subgraph is being updated
+      if _type_info(current_value)[0] == _NODE:
+        if value_kind == _VARIABLE or value_kind == _STATE_LEAF:
+          raise ValueError(
+            f'Expected a subgraph for {key!r}, but got: {value!r}'
+          )
+        stack.append(_update_dynamic_frame(current_value, value))
+        break
+      elif value_kind == _VARIABLE:
+        # case 3: state leaf is being updated
+        if not isinstance(current_value, Variable):
+          raise ValueError(
+            f'Trying to update a non-Variable attribute {key!r} with a '
+            f'Variable: {value!r}'
+          )
+        current_value.copy_from(value)
+      elif value_kind == _STATE_LEAF:
+        # case 4: state field is being updated
+        if isinstance(node_impl, PytreeNodeImpl):
+          raise ValueError(
+            f'Cannot set key {key!r} on immutable node of '
+            f'type {type(node).__name__}'
+          )
+        node_impl.set_key(node, key, value)
+      else:
         raise ValueError(
-          f'Cannot set key {key!r} on immutable node of '
-          f'type {type(node).__name__}'
+          f'Unsupported update type: {type(value)} for key {key!r}'
         )
-      node_impl.set_key(node, key, value)
     else:
-      raise ValueError(
-        f'Unsupported update type: {type(value)} for key {key!r}'
-      )
+      stack.pop()
+
+
+def _update_dynamic_frame(
+  node: tp.Any, state: tp.Mapping[Key, tp.Any]
+) -> tuple[
+  tp.Any,
+  NodeImpl[tp.Any, tp.Any, tp.Any],
+  dict[Key, tp.Any],
+  tp.Iterator[tuple[Key, tp.Any]],
+]:
+  node_impl = _lookup_node_impl(node)
+  if node_impl is None:
+    raise RuntimeError(f'Unsupported type: {type(node)}')
+  return node, node_impl, node_impl.node_dict(node), iter(state.items())
 
 
 class _StaticModuleStatus(enum.Enum):
@@ -806,7 +1060,7 @@ def update_from(node: Node, updates: Node) -> None:
 # TODO(cgarciae): remove once transform init are reimplemented
 def graph_update_static(node: Node, updates: Node) -> None:
   cache: dict[int, _StaticModuleStatus] = {}
-  _graph_update_static(node, updates, cache, _StaticModuleStatus.UPDATED, ())
+  _graph_update_static(node, updates, cache, _StaticModuleStatus.UPDATED, [])
 
 
 def _graph_update_static(
@@ -814,20 +1068,105 @@ def _graph_update_static(
   updates: Node,
   cache: dict[int, _StaticModuleStatus],
   status: _StaticModuleStatus,
-  path: PathParts,
+  path_stack: list[Key],
 ) -> None:
+  frame = _update_static_frame(node, updates, cache, status, path_stack)
+  if frame is None:
+    return
+
+  stack = [frame]
+  while stack:
+    node, node_impl, node_dict, items = stack[-1]
+    for name, value_updates in items:
+      kind = _type_info(value_updates)[0]
+      # case 1: trying to update a Variable, skip
+      if kind == _VARIABLE or kind == _STATE_LEAF:
+        continue
+      elif kind == _NODE:
+        # case 2: updating an existing subgraph
+        if name in node_dict:
+          path_stack.append(name)
+          frame = _update_static_frame(
+            node_dict[name],
+            value_updates,
+            cache,
+            _StaticModuleStatus.UPDATED,
+            path_stack,
+          )
+          if frame is None:
+            path_stack.pop()
+            continue
+          stack.append(frame)
+          break
+        else:
+          # case 3: adding a new subgraph
+          if isinstance(node_impl, PytreeNodeImpl):
+            raise ValueError(
+              f'Cannot set key {name!r} on immutable node of '
+              f'type {type(node).__name__}'
+            )
+
+          # check if the subgraph is already in the cache
+          if id(value_updates) in cache:
+            # if its in the cache, check its status is not NEW
+            if cache[id(value_updates)] is not _StaticModuleStatus.NEW:
+              raise ValueError(
+                f'Trying to add a new node at path {name!r} but a '
+                'node with the same reference has been updated'
+              )
+          else:
+            cache[id(value_updates)] = _StaticModuleStatus.NEW
+
+          node_impl.set_key(node, name, value_updates)
+      else:  # static field
+        if isinstance(node_impl, PytreeNodeImpl):
+          if name in node_dict and node_dict[name] == value_updates:
+            # if the value is the same, skip
+            continue
+          # if trying
+          raise ValueError(
+            f'Cannot update key {name!r} on immutable node of '
+            f'type {type(node).__name__}. Current value is '
+            f'{node_dict[name]!r}, new value is {value_updates!r}.'
+          )
+
+        node_impl.set_key(node, name, value_updates)
+    else:
+      stack.pop()
+      if stack:
+        path_stack.pop()
+
+
+def _update_static_frame(
+  node: Node,
+  updates: Node,
+  cache: dict[int, _StaticModuleStatus],
+  status: _StaticModuleStatus,
+  path_stack: list[Key],
+) -> (
+  tuple[
+    Node,
+    NodeImpl[Node, tp.Any, tp.Any],
+    dict[Key, tp.Any],
+    tp.Iterator[tuple[Key, tp.Any]],
+  ]
+  | None
+):
+  """Checks that ``node`` can be updated with ``updates``, returns the frame
+  to visit their attributes or None if ``updates`` was already visited."""
   if type(node) != type(updates):
     raise ValueError(
       f'Trying to update a node with a different type: '
       f'expected {type(node).__name__!r}, '
       f'but got {type(updates).__name__!r}'
     )
-  if not is_node(node):
+  node_impl = _lookup_node_impl(node)
+  if node_impl is None:
     raise ValueError(f'Unsupported node type: {type(node)}')
 
   if id(updates) in cache:
     if cache[id(updates)] != status:
-      str_path = '/'.join(path)
+      str_path = '/'.join(path_stack)
       if status is _StaticModuleStatus.NEW:
         raise ValueError(
           f'Trying to add a new node at path {str_path!r} but a'
@@ -838,61 +1177,13 @@ def _graph_update_static(
           f'Trying to update a node at path {str_path!r} but a new'
           ' node with the same reference has been added'
         )
-    return
+    return None
 
   cache[id(updates)] = status
 
-  node_impl = get_node_impl(node)
   node_dict = node_impl.node_dict(node)
-  updates_dict = node_impl.node_dict(updates)
-  for name, value_updates in updates_dict.items():
-    # case 1: trying to update a Variable, skip
-    if is_state_leaf(value_updates):
-      continue
-    elif is_node(value_updates):
-      # case 2: updating an existing subgraph
-      if name in node_dict:
-        _graph_update_static(
-          node_dict[name],
-          value_updates,
-          cache,
-          _StaticModuleStatus.UPDATED,
-          (*path, name),
-        )
-      else:
-        # case 3: adding a new subgraph
-        if isinstance(node_impl, PytreeNodeImpl):
-          raise ValueError(
-            f'Cannot set key {name!r} on immutable node of '
-            f'type {type(node).__name__}'
-          )
-
-        # check if the subgraph is already in the cache
-        if id(value_updates) in cache:
-          # if its in the cache, check its status is not NEW
-          if cache[id(value_updates)] is not _StaticModuleStatus.NEW:
-            raise ValueError(
-              f'Trying to add a new node at path {name!r} but a '
-              'node with the same reference has been updated'
-            )
-        else:
-          cache[id(value_updates)] = _StaticModuleStatus.NEW
-
-        node_impl.set_key(node, name, value_updates)
-    else:  # static field
-      if isinstance(node_impl, PytreeNodeImpl):
-        if name in node_dict and node_dict[name] == value_updates:
-          # if the value is the same, skip
-          continue
-        # if trying
-        raise ValueError(
-          f'Cannot update key {name!r} on immutable node of '
-          f'type {type(node).__name__}. Current value is {node_dict[name]!r}, '
-          f'new value is {value_updates!r}.'
-        )
-
-      node_impl.set_key(node, name, value_updates)
-
+  updates_items = iter(node_impl.node_items(updates))
+  return node, node_impl, node_dict, updates_items
 
 
 @tp.overload
@@ -937,15 +1228,20 @@ def full_split(
   RefMap[tp.Any, Index], GraphDef[A], State, tpe.Unpack[tuple[State, ...]]
 ]:
   graphdef, state, refmap = graph_flatten(graph_node, idxmap=idxmap)
+  assert refmap is not None
+  states = _split_state(state, filters)
+  return refmap, graphdef, states[0], *states[1:]
+
 
+def _split_state(
+  state: State, filters: tuple[filterlib.Filter, ...]
+) -> tuple[State, ...]:
   if len(filters) == 0:
-    states = (state,)
+    return (state,)
   elif len(filters) == 1:
-    states = (state.split(filters[0]),)
+    return (state.split(filters[0]),)
   else:
-    states = state.split(filters[0], filters[1], *filters[2:])
-
-  return refmap, graphdef, states[0], *states[1:]
+    return state.split(filters[0], filters[1], *filters[2:])
 
 
 def full_merge(
@@ -1008,8 +1304,10 @@ def split(
   graph_node: A,
   *filters: filterlib.Filter,
 ) -> tuple[GraphDef[A], State, tpe.Unpack[tuple[State, ...]]]:
-  _, graphdef, state, *states = full_split(graph_node, *filters)
-  return graphdef, state, *states
+  # the refmap is discarded, don't build it
+  graphdef, state, _ = graph_flatten(graph_node, need_refmap=False)
+  states = _split_state(state, filters)
+  return graphdef, states[0], *states[1:]
 
 
 def merge(
@@ -1022,10 +1320,12 @@ def merge(
 
 
 def update(node, state: State, *states: State) -> None:
-  if states:
-    state = State.merge(state, *states)
-
+  # applying the states in order is equivalent to merging them first, later
+  # states overwrite the values of earlier ones, but avoids flattening and
+  # rebuilding all of them
   _graph_update_dynamic(node, state.raw_mapping)
+  for state in states:
+    _graph_update_dynamic(node, state.raw_mapping)
 
 
 @tp.overload
@@ -1050,7 +1350,7 @@ def extract(
   /,
   *filters: filterlib.Filter,
 ) -> tp.Union[State, tuple[State, ...]]:
-  state = graph_flatten(node)[1]
+  state = graph_flatten(node, need_refmap=False)[1]
 
   if len(filters) == 0:
     states = state.extract(first)
@@ -1084,18 +1384,7 @@ def pop(node, *filters: filterlib.Filter) -> tp.Union[State, tuple[State, ...]]:
   if len(filters) == 0:
     raise ValueError('Expected at least one filter')
 
-  id_to_index: dict[int, Index] = {}
-  path_parts: PathParts = ()
-  predicates = tuple(filterlib.to_predicate(filter) for filter in filters)
-  flat_states: tuple[FlatState, ...] = tuple({} for _ in predicates)
-  _graph_pop(
-    node=node,
-    id_to_index=id_to_index,
-    path_parts=path_parts,
-    flat_states=flat_states,
-    predicates=predicates,
-  )
-  states = tuple(State.from_flat_path(flat_state) for flat_state in flat_states)
+  states = graph_pop(node, filters)
 
   if len(states) == 1:
     return states[0]
@@ -1122,6 +1411,18 @@ def _iter_nodes(
       yield path_parts, value
 
 
+def iter_node_values(node: tp.Any) -> tp.Iterator[tp.Any]:
+  """Like ``iter_nodes`` but only yields the nodes, without their paths."""
+  visited: set[int] = set()
+  yield from _iter_node_values(node, visited)
+
+
+def _iter_node_values(x: tp.Any, visited: set[int]) -> tp.Iterator[tp.Any]:
+  for value in _iter_all_values(x, visited):
+    if is_node(value):
+      yield value
+
+
 def _iter_node_or_variable(
   x: tp.Any, visited: set[int], path_parts: PathParts
 ) -> tp.Iterator[tuple[PathParts, tp.Any]]:
@@ -1130,6 +1431,14 @@ def _iter_node_or_variable(
       yield path_parts, value
 
 
+def _iter_node_or_variable_values(
+  x: tp.Any, visited: set[int]
+) -> tp.Iterator[tp.Any]:
+  for value in _iter_all_values(x, visited):
+    if is_node(value) or isinstance(value, Variable):
+      yield value
+
+
 def _iter_all(
   x: tp.Any, visited: set[int], path_parts: PathParts
 ) -> tp.Iterator[tuple[PathParts, tp.Any]]:
@@ -1137,23 +1446,81 @@ def _iter_all(
     return
   visited.add(id(x))
   yield path_parts, x
-  if is_node(x):
-    node_impl = get_node_impl(x)
-    node_dict = node_impl.node_dict(x)
-    for key, value in node_dict.items():
-      yield from _iter_all(value, visited, (*path_parts, key))
+  node_impl = _type_info(x)[1]
+  if node_impl is None:
+    return
+
+  # values are marked as visited when reached so each node is expanded once
+  stack = [(path_parts, iter(node_impl.node_items(x)))]
+  visited_add = visited.add
+  type_info_cache = CONTEXT.type_info_cache
+  while stack:
+    path_parts, items = stack[-1]
+    for key, value in items:
+      if id(value) in visited:
+        continue
+      visited_add(id(value))
+      value_path = (*path_parts, key)
+      yield value_path, value
+      info = type_info_cache.get(type(value))
+      if info is None:
+        info = _type_info(value)
+      node_impl = info[1]
+      if node_impl is not None:
+        stack.append((value_path, iter(node_impl.node_items(value))))
+        break
+    else:
+      stack.pop()
+
+
+def _iter_all_values(x: tp.Any, visited: set[int]) -> tp.Iterator[tp.Any]:
+  """Same traversal and order as ``_iter_all`` without building paths."""
+  if id(x) in visited:
+    return
+  visited.add(id(x))
+  yield x
+  node_impl = _type_info(x)[1]
+  if node_impl is None:
+    return
+
+  stack = [iter(node_impl.node_items(x))]
+  visited_add = visited.add
+  type_info_cache = CONTEXT.type_info_cache
+  while stack:
+    for _, value in stack[-1]:
+      if id(value) in visited:
+        continue
+      visited_add(id(value))
+      yield value
+      info = type_info_cache.get(type(value))
+      if info is None:
+        info = _type_info(value)
+      node_impl = info[1]
+      if node_impl is not None:
+        stack.append(iter(node_impl.node_items(value)))
+        break
+    else:
+      stack.pop()
 
 
 def compose_mapping(
   map_ab: tp.Mapping[A, B], map_bc: tp.Mapping[B, C], /
 ) -> dict[A, C]:
-  return {a: map_bc[b] for a, b in map_ab.items() if b in map_bc}
+  return {
+    a: c
+    for a, b in map_ab.items()
+    if (c := map_bc.get(b, _MISSING)) is not _MISSING
+  }
 
 
 def compose_mapping_reversed(
   map_ab: tp.Mapping[A, B], map_bc: tp.Mapping[B, C], /
 ) -> dict[C, A]:
-  return {map_bc[b]: a for a, b in map_ab.items() if b in map_bc}
+  return {
+    c: a
+    for a, b in map_ab.items()
+    if (c := map_bc.get(b, _MISSING)) is not _MISSING
+  }
 
 
 @dataclasses.dataclass(frozen=True)
@@ -1162,8 +1529,15 @@ class Static(tp.Generic[A]):
   ``value`` must define ``__eq__`` and ``__hash__``.
   """
 
+  # declared manually since dataclass(slots=True) requires Python 3.10
+  __slots__ = ('value',)
+
   value: A
 
+  def __reduce__(self):
+    # frozen instances can't be restored through the default setattr path
+    return type(self), (self.value,)
+
 
 jax.tree_util.register_static(Static)
 
@@ -1176,36 +1550,45 @@ jax.tree_util.register_static(Static)
 class GraphNodeIndex:
   """Index of a graph node in a Pytree structure."""
 
+  __slots__ = ('index',)
+
   index: int
 
+  def __reduce__(self):
+    return type(self), (self.index,)
+
 
 jax.tree_util.register_static(GraphNodeIndex)
 
 
 def extract_graph_nodes(pytree: A, /) -> tuple[A, tuple[tp.Any, ...]]:
   """Extracts all graph nodes from a pytree."""
-  nodes = RefMap[tp.Any, Index]()
-
-  def _maybe_extract(x):
-    if is_graph_node(x):
-      index = nodes.setdefault(x, len(nodes))
-      return GraphNodeIndex(index)
-    return x
-
-  return jax.tree_util.tree_map(_maybe_extract, pytree), tuple(nodes)
+  # the nodes list keeps the nodes alive so their ids can't be reused
+  leaves, treedef = jax.tree_util.tree_flatten(pytree)
+  node_index: dict[int, Index] = {}
+  nodes: list[tp.Any] = []
+  node_types = CONTEXT.node_types
+  for i, x in enumerate(leaves):
+    if type(x) in node_types:
+      index = node_index.get(id(x))
+      if index is None:
+        index = node_index[id(x)] = len(nodes)
+        nodes.append(x)
+      leaves[i] = GraphNodeIndex(index)
+
+  return treedef.unflatten(leaves), tuple(nodes)
 
 
 def insert_graph_nodes(pytree: A, nodes: tuple[tp.Any, ...], /) -> A:
   """Inserts graph nodes into a pytree."""
-
-  def _maybe_insert(x):
-    if isinstance(x, GraphNodeIndex):
-      return nodes[x.index]
-    return x
-
-  return jax.tree_util.tree_map(
-    _maybe_insert, pytree, is_leaf=lambda x: isinstance(x, GraphNodeIndex)
+  # GraphNodeIndex is a static pytree so it must be flattened as a leaf
+  leaves, treedef = jax.tree_util.tree_flatten(
+    pytree, is_leaf=lambda x: isinstance(x, GraphNodeIndex)
   )
+  leaves = [
+    nodes[x.index] if type(x) is GraphNodeIndex else x for x in leaves
+  ]
+  return treedef.unflatten(leaves)
 
 
 # ---------------------------------------------------------
@@ -1248,6 +1631,15 @@ def _graph_node_meta_call(cls: tp.Type[G], *args, **kwargs) -> G:
   return node
 
 
+@functools.lru_cache(maxsize=4096)
+def _sorted_attributes(keys: tuple[str, ...]) -> tuple[str, ...]:
+  return tuple(sorted(key for key in keys if key != '_graph_node__state'))
+
+
+def _defining_class(cls: type, name: str) -> type:
+  return next(base for base in cls.__mro__ if name in vars(base))
+
+
 class GraphNode(reprlib.Representable, metaclass=GraphNodeMeta):
   if tp.TYPE_CHECKING:
     _graph_node__state: ModuleState
@@ -1255,6 +1647,21 @@ class GraphNode(reprlib.Representable, metaclass=GraphNodeMeta):
   def __init_subclass__(cls) -> None:
     super().__init_subclass__()
 
+    # classes that don't customize how attributes are set can set all the
+    # attributes of an empty node at once, a class that customizes
+    # _graph_node_set_key can also provide a matching _graph_node_init
+    if (
+      issubclass(
+        _defining_class(cls, '_graph_node_init'),
+        _defining_class(cls, '_graph_node_set_key'),
+      )
+      and cls.__setattr__ is GraphNode.__setattr__
+      and cls._setattr is GraphNode._setattr
+    ):
+      init = cls._graph_node_init
+    else:
+      init = None
+
     graph_utils.register_graph_node_type(
       type=cls,
       flatten=cls._graph_node_flatten,
@@ -1262,6 +1669,7 @@ class GraphNode(reprlib.Representable, metaclass=GraphNodeMeta):
       pop_key=cls._graph_node_pop_key,
       create_empty=cls._graph_node_create_empty,
       clear=cls._graph_node_clear,
+      init=init,
     )
 
   if not tp.TYPE_CHECKING:
@@ -1281,8 +1689,8 @@ class GraphNode(reprlib.Representable, metaclass=GraphNodeMeta):
 
   def __deepcopy__(self: G, memo=None) -> G:
     graphdef, state = graph_utils.split(self)
-    graphdef = deepcopy(graphdef)
-    state = deepcopy(state)
+    graphdef = deepcopy(graphdef, memo)
+    state = deepcopy(state, memo)
     return merge(graphdef, state)
 
   def __hash__(self) -> int:
@@ -1314,25 +1722,37 @@ class GraphNode(reprlib.Representable, metaclass=GraphNodeMeta):
 
   # Graph Definition
   def _graph_node_flatten(self):
-    nodes = sorted(
-      (key, value)
-      for key, value in vars(self).items()
-      if key != '_graph_node__state'
-    )
+    # nodes of the same class usually have their attributes in the same
+    # insertion order, the sorted order is cached per insertion order
+    node_vars = vars(self)
+    sorted_keys = _sorted_attributes(tuple(node_vars))
+    nodes = [(key, node_vars[key]) for key in sorted_keys]
     return nodes, type(self)
 
   def _graph_node_set_key(self, key: Key, value: tp.Any):
     if not isinstance(key, str):
       raise KeyError(f'Invalid key: {key!r}')
-    elif (
-      hasattr(self, key)
-      and isinstance(variable := getattr(self, key), Variable)
-      and isinstance(value, Variable)
+    elif isinstance(value, Variable) and isinstance(
+      variable := vars(self).get(key), Variable
     ):
+      # graph node attributes live in the instance __dict__, a single dict
+      # lookup replaces the hasattr/getattr pair
       variable.copy_from(value)
     else:
       setattr(self, key, value)
 
+  def _graph_node_init(self, items: tuple[tuple[Key, tp.Any], ...]):
+    # only used on empty nodes, there are no existing Variables to update
+    if not items:
+      return
+    self.check_valid_context(
+      f"Cannot mutate '{type(self).__name__}' from different trace level"
+    )
+    for key, value in items:
+      if not isinstance(key, str):
+        raise KeyError(f'Invalid key: {key!r}')
+      object.__setattr__(self, key, value)
+
   def _graph_node_pop_key(self, key: Key):
     if not isinstance(key, str):
       raise KeyError(f'Invalid key: {key!r}')
@@ -1358,12 +1778,42 @@ class PytreeType:
   ...
 
 
+# answers for common exact types, avoids a call into the tree walker
+_PYTREE_QUICK: dict[type, bool] = {
+  dict: True,
+  list: True,
+  tuple: True,
+  type(None): True,
+  int: False,
+  float: False,
+  complex: False,
+  str: False,
+  bool: False,
+  bytes: False,
+}
+
+
 def is_pytree_node(x: tp.Any) -> bool:
+  result = _PYTREE_QUICK.get(type(x))
+  if result is not None:
+    return result
   return not jax.tree_util.all_leaves([x])
 
 
+# key getters by exact key type, subclasses go through the isinstance checks
+_KEY_DISPATCH: dict[type, tp.Callable[[tp.Any], Key]] = {
+  jax.tree_util.SequenceKey: operator.attrgetter('idx'),
+  jax.tree_util.DictKey: operator.attrgetter('key'),
+  jax.tree_util.FlattenedIndexKey: operator.attrgetter('key'),
+  jax.tree_util.GetAttrKey: operator.attrgetter('name'),
+}
+
+
 def _key_path_to_key(key: tp.Any) -> Key:
-  if isinstance(key, jax.tree_util.SequenceKey):
+  get_key = _KEY_DISPATCH.get(type(key))
+  if get_key is not None:
+    return get_key(key)
+  elif isinstance(key, jax.tree_util.SequenceKey):
     return key.idx
   elif isinstance(
     key, (jax.tree_util.DictKey, jax.tree_util.FlattenedIndexKey)
@@ -1375,18 +1825,80 @@ def _key_path_to_key(key: tp.Any) -> Key:
     return str(key)
 
 
-def _flatten_pytree(pytree: tp.Any):
+def _pytree_fingerprint(pytree: tp.Any) -> tp.Hashable | None:
+  """Returns a hashable value that determines the one level treedef of
+  ``pytree`` if it is a builtin container, else None."""
+  pytree_type = type(pytree)
+  if pytree_type is dict:
+    # the treedef stores the keys, only str keys are supported so equal
+    # keys of different types (e.g. 1 and True) are not conflated
+    keys = tuple(pytree)
+    if all(type(key) is str for key in keys):
+      return dict, keys
+  elif pytree_type is list or pytree_type is tuple:
+    return pytree_type, len(pytree)
+  elif pytree is None:
+    return pytree_type, 0
+  return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _builtin_pytree_treedef(
+  fingerprint: tp.Hashable,
+) -> tuple[tuple[Key, ...], jax.tree_util.PyTreeDef]:
+  """Returns the keys and one level treedef of the builtin containers with
+  the given fingerprint, computed from a placeholder container."""
+  pytree_type, size = fingerprint
+  if pytree_type is dict:
+    pytree = dict.fromkeys(size, 0)
+  elif pytree_type is type(None):
+    pytree = None
+  else:
+    pytree = pytree_type([0] * size)
+  nodes, treedef = _flatten_pytree_with_keys(pytree)
+  return tuple(key for key, _ in nodes), treedef
+
+
+def _flatten_pytree_with_keys(pytree: tp.Any):
   leaves, treedef = jax.tree_util.tree_flatten_with_path(
     pytree, is_leaf=lambda x: x is not pytree
   )
-  nodes = tuple((_key_path_to_key(path[0]), value) for path, value in leaves)
+  # paths have a single key since every child is a leaf
+  nodes = tuple((_key_path_to_key(key), value) for (key,), value in leaves)
+  return nodes, treedef
+
 
+def _flatten_pytree(pytree: tp.Any):
+  fingerprint = _pytree_fingerprint(pytree)
+  if fingerprint is None:
+    return _flatten_pytree_with_keys(pytree)
+
+  keys, treedef = _builtin_pytree_treedef(fingerprint)
+  if type(pytree) is dict:
+    nodes = tuple((key, pytree[key]) for key in keys)
+  elif keys:
+    nodes = tuple(zip(keys, pytree))
+  else:
+    nodes = ()
   return nodes, treedef
 
 
 def _unflatten_pytree(
   nodes: tuple[tuple[Key, tp.Any], ...], treedef: jax.tree_util.PyTreeDef
 ):
+  # builtin containers are rebuilt directly, nodes of a dict are in the
+  # sorted key order that jax uses so the result is the same. Mismatched
+  # counts go through treedef.unflatten which raises.
+  if len(nodes) == treedef.num_leaves:
+    node_type = treedef.node_data()[0]
+    if node_type is dict:
+      return dict(nodes)
+    elif node_type is list:
+      return [value for _, value in nodes]
+    elif node_type is tuple:
+      return tuple(value for _, value in nodes)
+    elif node_type is type(None):
+      return None
   pytree = treedef.unflatten(value for _, value in nodes)
   return pytree
 
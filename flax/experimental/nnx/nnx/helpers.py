@@ -107,11 +107,21 @@ class List(Module, tp.Generic[A]):
     return self._length
 
   def _graph_node_flatten(self):
-    nodes: list[tuple[Key, tp.Any]] = sorted(
-      (int(key), value)
-      for key, value in vars(self).items()
-      if key not in ('_graph_node__state', '_length')
-    )
+    # elements are stored as '0', '1', ... attributes, reading them by index
+    # avoids converting and sorting all the keys
+    node_vars = vars(self)
+    nodes: list[tuple[Key, tp.Any]] = []
+    for i in range(self._length):
+      key = str(i)
+      if key in node_vars:
+        nodes.append((i, node_vars[key]))
+    if len(nodes) + 2 != len(node_vars):
+      # attributes outside of 0.._length - 1, use the generic path
+      nodes = sorted(
+        (int(key), value)
+        for key, value in node_vars.items()
+        if key not in ('_graph_node__state', '_length')
+      )
     nodes.append(('_length', self._length))
     return nodes, type(self)
 
@@ -120,6 +130,14 @@ class List(Module, tp.Generic[A]):
       key = str(key)
     return super()._graph_node_set_key(key, value)
 
+  def _graph_node_init(self, items: tuple[tuple[Key, tp.Any], ...]):
+    super()._graph_node_init(
+      tuple(
+        (str(key) if isinstance(key, int) else key, value)
+        for key, value in items
+      )
+    )
+
   def _graph_node_pop_key(self, key: Key):
     if isinstance(key, int):
       key = str(key)
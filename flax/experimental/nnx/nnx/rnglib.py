@@ -314,7 +314,7 @@ def init(node: A, *args, **kwargs) -> A:
     rngs = args[0]
   else:
     rngs = Rngs(*args, **kwargs)
-  for _, value in graph_utils._iter_node_or_variable(node, set(), ()):
+  for value in graph_utils._iter_node_or_variable_values(node, set()):
     if isinstance(value, _HasRngInit):
       value.rng_init(rngs)
   return node
@@ -124,6 +124,21 @@ class State(tp.MutableMapping[Key, tp.Any], reprlib.Representable):
     nested_state = traverse_util.unflatten_dict(flat_state)
     return cls(nested_state)
 
+  @classmethod
+  def from_flat_pairs(
+    cls, flat_pairs: tp.Iterable[tuple[PathParts, StateLeaf]], /
+  ) -> State:
+    """Creates a State from ``(path, value)`` pairs with unique paths."""
+    nested_state: dict[Key, tp.Any] = {}
+    for path, value in flat_pairs:
+      cursor = nested_state
+      for key in path[:-1]:
+        if key not in cursor:
+          cursor[key] = {}
+        cursor = cursor[key]
+      cursor[path[-1]] = value
+    return cls(nested_state)
+
   @tp.overload
   def split(self, first: filterlib.Filter, /) -> 'State':
     ...
@@ -260,13 +275,13 @@ def _split_state(
     {} for _ in range(len(predicates) + 1)
   )
 
+  match = filterlib.to_combined_matcher(predicates)
   for path, value in flat_state.items():
-    for i, predicate in enumerate(predicates):
-      if predicate(path, value):
-        flat_states[i][path] = value
-        break
-    else:
-      # if we didn't break, set leaf to last state
+    i = match(path, value)
+    if i is None:
+      # if no predicate matched, set leaf to last state
       flat_states[-1][path] = value
+    else:
+      flat_states[i][path] = value
 
   return tuple(State.from_flat_path(flat_state) for flat_state in flat_states)
@@ -723,7 +723,9 @@ def grad_apply(options: GradOptions, f, args: tuple[tp.Any, ...]):
     out = f(*_args)
     out, out_nodes = graph_utils.extract_graph_nodes(out)
 
-    _, updates, _ = graph_utils.graph_flatten((input_nodes, out_nodes))
+    _, updates, _ = graph_utils.graph_flatten(
+      (input_nodes, out_nodes), need_refmap=False
+    )
 
     if options.has_aux:
       loss, aux = out
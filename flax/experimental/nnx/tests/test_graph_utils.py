@@ -12,13 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 from functools import partial
+import pickle
+import sys
 import jax
+import jax.numpy as jnp
 import pytest
 
 from flax.experimental import nnx
 from flax import struct
 
+# deep enough for a recursive traversal to hit the recursion limit
+DEEP_GRAPH_DEPTH = 3 * sys.getrecursionlimit()
+
+
+def deep_graph(bottom: nnx.Dict, **make_attributes):
+  """Nests ``bottom`` under ``DEEP_GRAPH_DEPTH`` levels of
+  ``nnx.Dict(child=...)``, ``make_attributes`` add fresh values per level."""
+  m = bottom
+  for _ in range(DEEP_GRAPH_DEPTH):
+    attributes = {name: make() for name, make in make_attributes.items()}
+    m = nnx.Dict(child=m, **attributes)
+  return m
+
+
+def deepest(m: nnx.Dict) -> nnx.Dict:
+  for _ in range(DEEP_GRAPH_DEPTH):
+    m = m.child
+  return m
+
 
 class TestGraphUtils:
   def test_flatten(self):
@@ -465,3 +488,190 @@ class TestGraphUtils:
     nnx.init(m, jax.random.key(0))
     assert isinstance(m.kernel.value, jax.Array)
     assert isinstance(m.bias.value, jax.Array)
+
+  def test_graphdef_pickle(self):
+    g = nnx.Dict(a=nnx.Param(1), b=nnx.Dict(c=3))
+    graphdef, _ = nnx.split(g)
+    hash(graphdef)
+
+    graphdef2 = pickle.loads(pickle.dumps(graphdef))
+
+    assert '_hash' not in vars(graphdef2)
+    assert '_hash' not in vars(graphdef2.nodedef)
+    assert graphdef2 == graphdef
+    assert hash(graphdef2) == hash(graphdef)
+
+  def test_static_pickle(self):
+    static = nnx.graph_utils.Static((1, 'a'))
+    index = nnx.graph_utils.GraphNodeIndex(3)
+
+    static2 = pickle.loads(pickle.dumps(static))
+    index2 = pickle.loads(pickle.dumps(index))
+
+    assert not hasattr(static2, '__dict__')
+    assert static2 == static
+    assert hash(static2) == hash(static)
+    assert index2 == index
+
+  def test_graphdef_hash_mixed_keys(self):
+    g = nnx.List([1, nnx.Param(2), 'a'])
+    graphdef, _ = nnx.split(g)
+    graphdef2, _ = nnx.split(nnx.List([1, nnx.Param(2), 'a']))
+
+    assert hash(graphdef) == hash(graphdef2)
+
+  def test_split_merge_deep_graph(self):
+    m = deep_graph(nnx.Dict(leaf=nnx.Param(1)))
+
+    graphdef, state = nnx.split(m)
+    m2 = nnx.merge(graphdef, state)
+
+    assert deepest(m2).leaf.value == 1
+
+  def test_merge_shared_subgraph_in_state(self):
+    a = nnx.Dict(b=nnx.Param(1))
+    graphdef, _ = nnx.split(nnx.Dict(x=a, y=a))
+    state = nnx.State({'x': {'b': nnx.Param(2)}, 'y': {'b': nnx.Param(2)}})
+
+    g = nnx.merge(graphdef, state)
+
+    assert g.y is g.x
+    assert g.x.b.value == 2
+
+  def test_graph_flatten_without_refmap(self):
+    p = nnx.Param(1)
+    g = nnx.Dict(a=p, b=nnx.Dict(c=p))
+
+    graphdef, state, refmap = nnx.graph_utils.graph_flatten(g)
+    graphdef2, state2, refmap2 = nnx.graph_utils.graph_flatten(
+      g, need_refmap=False
+    )
+
+    assert refmap2 is None
+    assert refmap is not None
+    assert refmap[g] == 0
+    assert refmap[p] == 1
+    assert graphdef2 == graphdef
+    assert state2 == state
+
+  def test_update_deep_graph(self):
+    m = deep_graph(nnx.Dict(leaf=nnx.Param(1)))
+    nnx.graph_utils.graph_update_static(
+      m, deep_graph(nnx.Dict(leaf=nnx.Param(2)))
+    )
+    _, state = nnx.split(deep_graph(nnx.Dict(leaf=nnx.Param(3))))
+    nnx.update(m, state)
+
+    assert deepest(m).leaf.value == 3
+
+  def test_pop_deep_graph(self):
+    m = deep_graph(
+      nnx.Dict(leaf=nnx.Param(1), stat=nnx.BatchStat(2)),
+      stat=lambda: nnx.BatchStat(0),
+    )
+
+    stats = nnx.pop(m, nnx.BatchStat)
+
+    for _ in range(DEEP_GRAPH_DEPTH):
+      assert stats['stat'].value == 0
+      assert not hasattr(m, 'stat')
+      stats, m = stats['child'], m.child
+    assert stats['stat'].value == 2
+    assert not hasattr(m, 'stat')
+    assert m.leaf.value == 1
+
+  def test_list_split_merge(self):
+    g = nnx.List([nnx.Param(i) for i in range(12)])
+    nnx.pop(g, lambda path, x: path == (3,))
+
+    graphdef, state = nnx.split(g)
+    g2 = nnx.merge(graphdef, state)
+
+    assert graphdef.nodedef.attributes == (
+      *(i for i in range(12) if i != 3),
+      '_length',
+    )
+    assert vars(g2).keys() == vars(g).keys()
+    assert [g2[i].value for i in range(12) if i != 3] == [
+      i for i in range(12) if i != 3
+    ]
+
+  def test_iter_nodes_deep_graph(self):
+    m = deep_graph(nnx.Dict(leaf=nnx.Param(1)))
+
+    paths = [path for path, _ in nnx.graph_utils.iter_nodes(m)]
+
+    assert len(paths) == DEEP_GRAPH_DEPTH + 1
+    assert paths[-1] == ('child',) * DEEP_GRAPH_DEPTH
+
+  def test_iter_node_values(self):
+    a = nnx.Dict(b=nnx.Param(1), c=[2, nnx.List([3])])
+    g = nnx.List([a, {'d': a, 'e': nnx.Dict()}])
+
+    nodes = [node for _, node in nnx.graph_utils.iter_nodes(g)]
+    values = list(nnx.graph_utils.iter_node_values(g))
+
+    assert len(values) == len(nodes)
+    assert all(v is n for v, n in zip(values, nodes))
+
+  def test_pytree_treedef_cache(self):
+    for _ in range(2):
+      g = nnx.Dict(a={'b': nnx.Param(1), 'a': 2}, b=(3, None), c=[4])
+      graphdef, state = nnx.split(g)
+      g2 = nnx.merge(graphdef, state)
+
+      assert g2.a['b'].value == 1
+      assert g2.a['a'] == 2
+      assert g2.b == (3, None)
+      assert g2.c == [4]
+
+    g = nnx.Dict(a={1: 'x'}, b={True: 'y'})
+    g2 = nnx.merge(*nnx.split(g))
+
+    assert type(next(iter(g2.a))) is int
+    assert type(next(iter(g2.b))) is bool
+
+  def test_merge_malformed_pytree_state(self):
+    g = nnx.Dict(a=[jnp.ones(1), jnp.zeros(2)])
+    graphdef, _ = nnx.split(g)
+    state = nnx.State({'a': {0: {'x': jnp.ones(1)}, 1: jnp.zeros(2)}})
+
+    with pytest.raises(ValueError, match='Too few leaves for PyTreeDef'):
+      nnx.merge(graphdef, state)
+
+  def test_late_pytree_registration(self):
+    class Foo:
+      def __init__(self, x):
+        self.x = x
+
+    g = nnx.Dict(f=Foo(nnx.Param(1)))
+    _, state = nnx.split(g)
+    assert len(state.flat_state()) == 0
+
+    jax.tree_util.register_pytree_node(
+      Foo, lambda foo: ((foo.x,), None), lambda _, xs: Foo(*xs)
+    )
+    _, state = nnx.split(g)
+
+    assert list(state.flat_state()) == [('f', 0)]
+
+  def test_unflatten_pytree_containers(self):
+    Point = collections.namedtuple('Point', ['x', 'y'])
+    pytrees = [{'b': 1, 'a': 2}, [1, 2], (1, 2), None, Point(1, 2)]
+
+    for pytree in pytrees:
+      nodes, treedef = nnx.graph_utils._flatten_pytree(pytree)
+      pytree2 = nnx.graph_utils._unflatten_pytree(nodes, treedef)
+
+      assert type(pytree2) is type(pytree)
+      assert pytree2 == pytree
+
+  def test_update_multiple_states(self):
+    g = nnx.Dict(a=nnx.Param(1), b=nnx.Dict(c=nnx.Param(2)))
+    state1 = nnx.State({'a': nnx.Param(10), 'b': {'c': nnx.Param(20)}})
+    state2 = nnx.State({'b': {'c': nnx.Param(30)}})
+
+    nnx.update(g, state1, state2)
+
+    assert g.a.value == 10
+    assert g.b.c.value == 30
@@ -21,6 +21,7 @@ import jax.numpy as jnp
 import numpy as np
 import pytest
 
+from flax import struct
 from flax.experimental import nnx
 
 A = TypeVar('A')
@@ -411,6 +412,42 @@ class TestModule:
     assert m1.b is not m2.b
     assert m1.c is not m2.c
     assert m1.self is m1
+    assert m2.self is m2
+
+    m2.a.value = 2
+    m2.b.append(4)
+    assert m1.a.value == 1
+    assert m1.b == [1, 2, 3]
+
+  def test_deepcopy_static_attribute(self):
+    class Cfg:
+      def __init__(self):
+        self.features = 2
+
+    @struct.dataclass
+    class Tree:
+      a: int
+      tags: list = struct.field(pytree_node=False)
+
+    class Foo(nnx.Module):
+      def __init__(self) -> None:
+        self.cfg = Cfg()
+        self.sub = nnx.Dict(cfg=Cfg())
+        self.tree = Tree(1, [1, 2])
+
+    m1 = Foo()
+    m2 = deepcopy(m1)
+
+    assert m2.cfg is not m1.cfg
+    assert m2.sub.cfg is not m1.sub.cfg
+    assert m2.tree.tags is not m1.tree.tags
+
+    m2.cfg.features = 3
+    m2.sub.cfg.features = 3
+    m2.tree.tags.append(3)
+    assert m1.cfg.features == 2
+    assert m1.sub.cfg.features == 2
+    assert m1.tree.tags == [1, 2]
 
   def test_set_attributes(self):
     class Block(nnx.Module):
@@ -62,3 +62,32 @@ class StateTest(TestCase):
     assert state.layers[0].kernel.raw_value.shape == (1, 2)
     assert module.layers[1].kernel.value.shape == (2, 3)
     assert state.layers[1].kernel.raw_value.shape == (2, 3)
+
+  def test_split_type_and_path_filters(self):
+    state = nnx.State(
+      {
+        'a': nnx.Param(1),
+        'b': nnx.BatchStat(2),
+        'c': {'a': nnx.BatchStat(3), 'b': nnx.Param(4)},
+      }
+    )
+
+    params, batch_stats = state.split(nnx.Param, ...)
+    assert set(params.flat_state()) == {('a',), ('c', 'b')}
+    assert set(batch_stats.flat_state()) == {('b',), ('c', 'a')}
+
+    in_c, params, rest = state.split(
+      lambda path, x: path[0] == 'c', nnx.Param, ...
+    )
+    assert set(in_c.flat_state()) == {('c', 'a'), ('c', 'b')}
+    assert set(params.flat_state()) == {('a',)}
+    assert set(rest.flat_state()) == {('b',)}
+
+  def test_from_flat_pairs(self):
+    flat_state = {('a',): nnx.Param(1), ('c', 'b'): nnx.Param(2)}
+
+    state1 = nnx.State.from_flat_path(flat_state)
+    state2 = nnx.State.from_flat_pairs(list(flat_state.items()))
+
+    assert state1.flat_state() == state2.flat_state()
+    assert state2.c.b.value == 2